@@ -1,14 +1,19 @@
 # ============================================
 # IMPORT LIBRARIES
 # ============================================
+# LangChain, ChromaDB and numpy are imported where they are first used, so
+# the page renders before those heavy modules finish loading
 import streamlit as st
-from langchain_openai import OpenAIEmbeddings, ChatOpenAI
-from langchain_community.vectorstores import Chroma
-from langchain.chains.conversational_retrieval.base import ConversationalRetrievalChain
-from langchain.memory import ConversationBufferMemory
 from dotenv import load_dotenv
+from array import array
+from contextlib import closing
+from difflib import SequenceMatcher
+import asyncio
 import os
-import openai, langchain_openai, streamlit as st
+import queue
+import sqlite3
+import threading
+os.environ["ANONYMIZED_TELEMETRY"] = "False"  # Disable ChromaDB telemetry
 
 st.set_page_config(
     page_title="Interkultureller Garten Coswig Assistant",
@@ -27,6 +32,230 @@ if "OPENAI_API_KEY" not in os.environ:
         load_dotenv()
 
 
+# ============================================
+# PROMPTS
+# ============================================
+# Turns a follow-up into a short search query (only used for retrieval)
+CONDENSE_QUESTION_TEMPLATE = (
+    "Rewrite the follow-up question as a short standalone search query, "
+    "in the language of the question.\n\n"
+    "Chat history:\n{chat_history}\n"
+    "Follow-up question: {question}\n"
+    "Search query:"
+)
+
+ANSWER_SYSTEM_TEMPLATE = (
+    "You are the assistant of the Interkultureller Garten Coswig e.V. "
+    "Answer using only the context below. If the answer is not in the "
+    "context, say that you don't know. Reply in the language of the "
+    "question.\n\nContext:\n{context}"
+)
+
+
+# ============================================
+# SHARED RESOURCES
+# ============================================
+CHROMA_DIR = "./chroma_db"
+COLLECTION_NAME = "langchain"  # Collection written by ingest.py
+FAQ_DB_PATH = os.path.join(CHROMA_DIR, "faq_embeddings.sqlite3")
+
+
+def normalize_question(text: str) -> str:
+    """Lowercase and collapse whitespace (must match ingest.py)"""
+    return " ".join(text.lower().split())
+
+
+# Loaded once per process and shared by all sessions
+# (show_spinner=False: also called from the event loop, see get_event_loop)
+@st.cache_resource(show_spinner=False)
+def get_http_clients():
+    """Create the keep-alive HTTP clients shared by all OpenAI calls"""
+    import httpx
+    limits = httpx.Limits(max_keepalive_connections=20, max_connections=40)
+    return {
+        "http_client": httpx.Client(timeout=30, limits=limits),
+        # Only used on the background event loop, which outlives every session
+        "http_async_client": httpx.AsyncClient(timeout=30, limits=limits)
+    }
+
+
+@st.cache_resource(show_spinner=False)
+def get_embeddings():
+    """Create the embeddings client"""
+    from langchain_openai import OpenAIEmbeddings
+    return OpenAIEmbeddings(**get_http_clients())
+
+
+@st.cache_resource(show_spinner=False)
+def get_faq_embeddings() -> dict:
+    """Load the FAQ question vectors precomputed by ingest.py"""
+    if not os.path.exists(FAQ_DB_PATH):
+        return {}
+    with closing(sqlite3.connect(FAQ_DB_PATH)) as conn:
+        rows = conn.execute("SELECT question, embedding FROM faq_embeddings")
+        return {question: array("f", blob).tolist() for question, blob in rows}
+
+
+@st.cache_data(ttl=3600, max_entries=2000, show_spinner=False)
+def embed_query_cached(query: str) -> list[float]:
+    """Embed a user question, reusing the vector for repeated questions"""
+    vector = get_faq_embeddings().get(normalize_question(query))
+    if vector is not None:
+        return vector
+    return get_embeddings().embed_query(query)
+
+
+@st.cache_resource
+def get_chroma_client(persist_dir: str):
+    """Open the persisted ChromaDB client"""
+    import chromadb
+    from chromadb.config import Settings
+    return chromadb.PersistentClient(
+        path=persist_dir,
+        settings=Settings(anonymized_telemetry=False, is_persistent=True)
+    )
+
+
+@st.cache_resource(max_entries=1)
+def get_collection(modified: float):
+    """Open the persisted vector database"""
+    # Keyed like get_collection_info: ingest.py recreates the collection, so a
+    # handle from before a re-ingest points at a collection that is gone
+    return get_chroma_client(CHROMA_DIR).get_collection(COLLECTION_NAME)
+
+
+@st.cache_data(persist="disk")
+def get_collection_info(persist_dir: str, modified: float) -> dict:
+    """Read the chunk count of the index (cached on disk)"""
+    # `modified` is only part of the cache key, so a new ingest is picked up
+    collection = get_chroma_client(persist_dir).get_collection(COLLECTION_NAME)
+    return {"n": collection.count()}
+
+
+@st.cache_resource(show_spinner=False)
+def get_llm():
+    """Create the chat model that writes the answer"""
+    from langchain_openai import ChatOpenAI
+    return ChatOpenAI(
+        model="gpt-4o-mini",
+        temperature=0,
+        max_tokens=256,  # FAQ answers are short, stop runaway generations
+        **get_http_clients()
+    )
+
+
+@st.cache_resource(show_spinner=False)
+def get_condense_llm():
+    """Create the chat model that rephrases follow-up questions"""
+    from langchain_openai import ChatOpenAI
+    return ChatOpenAI(
+        model="gpt-4o-mini",
+        temperature=0,
+        max_tokens=64,
+        **get_http_clients()
+    )
+
+
+# ============================================
+# RETRIEVAL AND ANSWERING
+# ============================================
+HISTORY_TURNS = 4  # Question/answer pairs the models get to see
+ROLES = {"user": "human", "assistant": "ai"}
+SAME_QUERY_RATIO = 0.9  # Rewrites this similar to the question reuse its vector
+
+
+def retrieve(collection, vector: list[float], fetch_k: int, k: int = 2) -> list[str]:
+    """Pick k diverse chunks out of the fetch_k closest ones (MMR)"""
+    import numpy as np
+    from langchain_community.vectorstores.utils import maximal_marginal_relevance
+    hits = collection.query(
+        query_embeddings=[vector],
+        n_results=fetch_k,
+        include=["documents", "embeddings"]
+    )
+    selected = maximal_marginal_relevance(
+        np.array(vector, dtype=np.float32),
+        hits["embeddings"][0],
+        lambda_mult=0.5,
+        k=k
+    )
+    return [hits["documents"][0][i] for i in selected]
+
+
+def is_same_query(rewrite: str, question: str) -> bool:
+    """Tell if a rewrite is close enough to reuse the question's embedding"""
+    ratio = SequenceMatcher(
+        None, normalize_question(rewrite), normalize_question(question)
+    ).ratio()
+    return ratio >= SAME_QUERY_RATIO
+
+
+def format_history(history: list[dict]) -> str:
+    """Render chat messages as plain text for the rewrite prompt"""
+    return "\n".join(
+        f"{'User' if message['role'] == 'user' else 'Assistant'}: {message['content']}"
+        for message in history
+    )
+
+
+async def answer_turn(question, history, collection, fetch_k, tokens: queue.Queue):
+    """Retrieve context for a question and put the answer tokens on a queue"""
+    # Embed the question as asked while a follow-up is being rewritten
+    speculative = asyncio.to_thread(embed_query_cached, question)
+    if history:
+        # Rewrite follow-ups into a standalone search query
+        rewrite, vector = await asyncio.gather(
+            get_condense_llm().ainvoke(
+                CONDENSE_QUESTION_TEMPLATE.format(
+                    chat_history=format_history(history),
+                    question=question
+                )
+            ),
+            speculative
+        )
+        if not is_same_query(rewrite.content, question):
+            vector = await asyncio.to_thread(embed_query_cached, rewrite.content)
+    else:
+        vector = await speculative
+    
+    context = await asyncio.to_thread(retrieve, collection, vector, fetch_k)
+    messages = [
+        ("system", ANSWER_SYSTEM_TEMPLATE.format(context="\n\n".join(context))),
+        *[(ROLES[message["role"]], message["content"]) for message in history],
+        ("human", question)
+    ]
+    async for chunk in get_llm().astream(messages):
+        tokens.put(chunk.content)
+
+
+@st.cache_resource
+def get_event_loop():
+    """Start the background event loop that answers questions"""
+    # Code on this loop (and its executor threads) has no Streamlit session
+    # context. It must not make UI calls, and any cached function it reaches
+    # needs show_spinner=False, since the spinner is a UI call.
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return loop
+
+
+def stream_answer(question, history, collection, fetch_k):
+    """Answer a question asynchronously and yield tokens as they arrive"""
+    tokens = queue.Queue()
+    future = asyncio.run_coroutine_threadsafe(
+        answer_turn(question, history, collection, fetch_k, tokens),
+        get_event_loop()
+    )
+    future.add_done_callback(lambda _: tokens.put(None))
+    try:
+        while (token := tokens.get()) is not None:
+            yield token
+        future.result()  # Re-raise any error from the turn
+    finally:
+        # Stop the turn if Streamlit abandons the stream (new message, tab closed)
+        future.cancel()
+
+
 # ============================================
 # DISPLAY TITLE
 # ============================================
@@ -39,35 +268,27 @@ st.caption("Frag mich alles über den Interkulturellen Garten Coswig e.V.")
 if "messages" not in st.session_state:
     st.session_state.messages = []
 
-if "chain" not in st.session_state:
-    try:
-        # Load vector database
-        embeddings = OpenAIEmbeddings()
-        vectorstore = Chroma(
-            persist_directory="./chroma_db",
-            embedding_function=embeddings
-        )
-        
-        # Create conversation memory
-        memory = ConversationBufferMemory(
-            memory_key="chat_history",
-            return_messages=True,
-            output_key="answer"
-        )
-        
-        # Create AI chain
-        st.session_state.chain = ConversationalRetrievalChain.from_llm(
-            llm=ChatOpenAI(
-                model="gpt-3.5-turbo",
-                temperature=0
-            ),
-            retriever=vectorstore.as_retriever(search_kwargs={"k": 2}),
-            memory=memory,
-            return_source_documents=True
-        )
-    except Exception as e:
-        st.error(f"❌ Error initializing chatbot: {e}")
-        st.stop()
+# ============================================
+# LOAD KNOWLEDGE BASE
+# ============================================
+try:
+    # Changes whenever ingest.py rebuilds the index
+    index_modified = os.path.getmtime(os.path.join(CHROMA_DIR, "chroma.sqlite3"))
+    info = get_collection_info(CHROMA_DIR, index_modified)
+    collection = get_collection(index_modified)
+    # Open shared resources now, so setup errors show before the first question
+    get_llm()
+    get_condense_llm()
+except Exception as e:
+    st.error(f"❌ Error initializing chatbot: {e}")
+    st.stop()
+
+if info["n"] == 0:
+    st.error("❌ The knowledge base is empty. Run ingest.py first.")
+    st.stop()
+
+# MMR picks 2 diverse chunks out of the 10 closest ones
+fetch_k = min(10, info["n"])
 
 # ============================================
 # DISPLAY CHAT HISTORY
@@ -81,6 +302,16 @@ for message in st.session_state.messages:
 # ============================================
 if prompt := st.chat_input("Type your question here..."):
     
+    # Last few turns before this question (per user session)
+    history = st.session_state.messages[-2 * HISTORY_TURNS:]
+    
+    # Answer of the previous turn if this is the same question resubmitted
+    repeated_answer = None
+    if (len(history) >= 2 and history[-2]["role"] == "user"
+            and history[-2]["content"] == prompt
+            and history[-1]["role"] == "assistant"):
+        repeated_answer = history[-1]["content"]
+    
     # Add user message
     st.session_state.messages.append({"role": "user", "content": prompt})
     with st.chat_message("user"):
@@ -88,13 +319,15 @@ if prompt := st.chat_input("Type your question here..."):
     
     # Get bot response
     with st.chat_message("assistant"):
-        with st.spinner("💭"):
-            try:
-                response = st.session_state.chain.invoke({"question": prompt})
-                answer = response["answer"]
+        try:
+            if repeated_answer is not None:
+                # Skip the models, they would see the same question again
+                answer = repeated_answer
                 st.write(answer)
-                
-                # Add to history
-                st.session_state.messages.append({"role": "assistant", "content": answer})
-            except Exception as e:
-                st.error(f"Error: {e}")
\ No newline at end of file
+            else:
+                answer = st.write_stream(stream_answer(prompt, history, collection, fetch_k))
+            
+            # Add to history
+            st.session_state.messages.append({"role": "assistant", "content": answer})
+        except Exception as e:
+            st.error(f"Error: {e}")
\ No newline at end of file
@@ -1,43 +1,173 @@
-from langchain_community.document_loaders import TextLoader
+from langchain_core.documents import Document
 from langchain_openai import OpenAIEmbeddings
-from langchain.text_splitter import CharacterTextSplitter
+from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain_community.vectorstores import Chroma
 from dotenv import load_dotenv
 
+from array import array
+from contextlib import closing
+import asyncio
+import hashlib
+import mmap
 import os
+import sqlite3
+import uuid
 os.environ["ANONYMIZED_TELEMETRY"] = "False"  # Disable ChromaDB telemetry
 
+import chromadb
+from chromadb.config import Settings
+
 # Load environment variables
 load_dotenv()
 
+COLLECTION_NAME = "langchain"  # Default collection the app reads from
+EMBED_BATCH_SIZE = 1000  # Texts per embeddings API request
+MAX_CONCURRENT_REQUESTS = 20
+LOAD_BLOCK_SIZE = 1 << 20  # Bytes decoded at a time when loading text
+FAQ_SEED_PATH = "data/faq_seed.txt"
+FAQ_DB_PATH = "./chroma_db/faq_embeddings.sqlite3"
+HNSW_SETTINGS = {
+    "hnsw:space": "cosine",  # OpenAI embeddings are normalized
+    "hnsw:M": 32,
+    "hnsw:construction_ef": 200,
+    "hnsw:search_ef": 64
+}
+
+async def embed_chunks(embeddings, texts):
+    """Embed texts in batches, sending several API requests at once"""
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+
+    async def embed_batch(batch):
+        async with semaphore:
+            return await embeddings.aembed_documents(batch)
+
+    batches = [
+        texts[i:i + EMBED_BATCH_SIZE]
+        for i in range(0, len(texts), EMBED_BATCH_SIZE)
+    ]
+    results = await asyncio.gather(*(embed_batch(batch) for batch in batches))
+    return [vector for batch in results for vector in batch]
+
+def load_text(path):
+    """Load a UTF-8 text file through mmap as line-aligned ~1 MB documents"""
+    documents = []
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return documents  # mmap cannot map an empty file
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            start = 0
+            while start < len(mm):
+                end = min(start + LOAD_BLOCK_SIZE, len(mm))
+                if end < len(mm):
+                    # Cut after the last newline so no line is split
+                    newline = mm.rfind(b"\n", start, end)
+                    if newline != -1:
+                        end = newline + 1
+                    else:
+                        # No newline: at least don't split a UTF-8 character
+                        while end > start + 1 and mm[end] & 0xC0 == 0x80:
+                            end -= 1
+                documents.append(Document(
+                    page_content=mm[start:end].decode("utf-8"),
+                    metadata={"source": path}
+                ))
+                start = end
+    return documents
+
+def normalize_question(text):
+    """Lowercase and collapse whitespace (must match app.py)"""
+    return " ".join(text.lower().split())
+
+def ingest_faq_seeds(embeddings):
+    """Precompute embeddings for common questions so the app can skip the API"""
+    if not os.path.exists(FAQ_SEED_PATH):
+        return 0
+    with open(FAQ_SEED_PATH, encoding="utf-8") as f:
+        # Keyed by the normalized form the app looks up
+        seeds = {normalize_question(line): line.strip() for line in f if line.strip()}
+    vectors = embeddings.embed_documents(list(seeds.values()))
+    
+    with closing(sqlite3.connect(FAQ_DB_PATH)) as conn, conn:
+        conn.execute("DROP TABLE IF EXISTS faq_embeddings")
+        conn.execute(
+            "CREATE TABLE faq_embeddings "
+            "(question TEXT PRIMARY KEY, embedding BLOB NOT NULL)"
+        )
+        conn.executemany(
+            "INSERT INTO faq_embeddings VALUES (?, ?)",
+            [(seed, array("f", vector).tobytes()) for seed, vector in zip(seeds, vectors)]
+        )
+    return len(seeds)
+
+def deduplicate_chunks(chunks):
+    """Drop chunks whose text was already seen, so it is only embedded once"""
+    seen = set()
+    unique = []
+    for chunk in chunks:
+        digest = hashlib.blake2b(chunk.page_content.encode(), digest_size=16).digest()
+        if digest not in seen:
+            seen.add(digest)
+            unique.append(chunk)
+    return unique
+
 def ingest_documents():
     """Load documents and create vector store"""
     
     print("Loading documents...")
     # Load the text file
-    loader = TextLoader("data/sample.txt")
-    documents = loader.load()
+    documents = load_text("data/sample.txt")
     
     print("Splitting text...")
     # Split into chunks
-    text_splitter = CharacterTextSplitter(
-        chunk_size=1000,
-        chunk_overlap=200
+    text_splitter = RecursiveCharacterTextSplitter(
+        chunk_size=800,
+        chunk_overlap=120,
+        separators=["\n\n", "\n", ". ", " ", ""],
+        length_function=len
     )
-    chunks = text_splitter.split_documents(documents)
+    chunks = deduplicate_chunks(text_splitter.split_documents(documents))
     print(f"Created {len(chunks)} chunks")
     
     print("Creating embeddings...")
     # Create embeddings
-    embeddings = OpenAIEmbeddings()
+    embeddings = OpenAIEmbeddings(
+        chunk_size=EMBED_BATCH_SIZE,
+        max_retries=6
+    )
+    texts = [chunk.page_content for chunk in chunks]
+    vectors = asyncio.run(embed_chunks(embeddings, texts))
     
     print("Creating vector store...")
-    # Create vector store
-    vectorstore = Chroma.from_documents(
-        documents=chunks,
-        embedding=embeddings,
-        persist_directory="./chroma_db"
+    # Store the precomputed vectors
+    client = chromadb.PersistentClient(
+        path="./chroma_db",
+        settings=Settings(anonymized_telemetry=False, is_persistent=True)
     )
+    # Rebuild from scratch: HNSW settings only apply when a collection is created
+    try:
+        client.delete_collection(COLLECTION_NAME)
+    except ValueError:
+        pass  # Nothing ingested yet
+    collection = client.create_collection(
+        COLLECTION_NAME,
+        metadata=HNSW_SETTINGS
+    )
+    for i in range(0, len(chunks), client.max_batch_size):
+        batch = slice(i, i + client.max_batch_size)
+        collection.add(
+            ids=[str(uuid.uuid4()) for _ in chunks[batch]],
+            embeddings=vectors[batch],
+            documents=texts[batch],
+            metadatas=[chunk.metadata for chunk in chunks[batch]]
+        )
+    vectorstore = Chroma(
+        client=client,
+        collection_name=COLLECTION_NAME,
+        embedding_function=embeddings
+    )
+    
+    print("Precomputing FAQ question embeddings...")
+    print(f"Stored {ingest_faq_seeds(embeddings)} FAQ questions")
     
     print("✅ Documents ingested successfully!")
     return vectorstore
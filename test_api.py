@@ -11,7 +11,7 @@ print("This will cost about $0.0001 (basically free!)")
 
 try:
     response=client.chat.completions.create(
-        model="gpt-3.5-turbo",
+        model="gpt-4o-mini",
         messages=[
             {"role": "system", "content": "You are a helpful assistant."},
             {"role": "user", "content": "Say 'Hello! API is working!' in one sentence."}